@@ -0,0 +1,176 @@
+"""
+Shared HTTP layer for talking to the Alinea moderation API.
+
+Both the FastAPI proxy (main.py) and the CLI sanity check (sanity_main.py)
+go through this module, so there is one place to tune retries, timeouts
+and concurrency. Each caller owns its own AlineaUpstream (client + pool).
+"""
+import asyncio
+import json
+import os
+import random
+import re
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, List, Optional
+
+import httpx
+import orjson
+
+ALINIA_API_URL = "https://api.alinia.ai/moderations/"
+TIMEOUT_S = float(os.getenv("HTTP_TIMEOUT_S", "15"))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRY_BACKOFF_BASE_S = 0.8
+RETRY_BACKOFF_CAP_S = 8.0
+RETRY_BUDGET_S = 10.0  # max total time spent sleeping between retries of one call
+MAX_CONCURRENCY = int(os.getenv("ALINIA_MAX_CONCURRENCY", "20"))
+
+# A str decoded from JSON only holds surrogate code points when they were unpaired
+_LONE_SURROGATE = re.compile("[\ud800-\udfff]")
+
+DEFAULT_DETECTION_CONFIG: Dict[str, Any] = {
+    "security": {"adversarial": True},
+    "safety": {"wrongdoing": True},
+}
+
+class AlineaError(Exception):
+    """Upstream call failed; carries the HTTP status and body to surface to callers."""
+
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(f"Alinea API error {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+class AlineaUpstream:
+    """
+    One connection pool to Alinea plus its concurrency cap.
+
+    Each owner (the proxy's lifespan, an AlineaClient) builds its own
+    instance, so closing or re-keying one never affects another. The
+    client and semaphore belong to whichever event loop first uses them.
+    """
+
+    def __init__(
+        self, api_key: Optional[str] = None, *, transport: Optional[httpx.AsyncBaseTransport] = None
+    ) -> None:
+        api_key = api_key or os.getenv("ALINIA_API_KEY")
+        # Set once on the client so upstream calls never pass headers themselves
+        headers = {"accept": "application/json", "Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        self.has_api_key = bool(api_key)
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=TIMEOUT_S,
+            http2=transport is None,
+            transport=transport,
+        )
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+def _backoff_s(attempt: int, base: float = RETRY_BACKOFF_BASE_S) -> float:
+    # "Full jitter": spreads retries out so clients don't retry in lockstep
+    return random.uniform(0, min(RETRY_BACKOFF_CAP_S, base * (2 ** attempt)))
+
+def _retry_after_s(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds from now."""
+    if not value:
+        return None
+    value = value.strip()
+    # isdigit() alone accepts e.g. "\xb2" (a latin-1 decoded header byte), which float() rejects
+    if value.isascii() and value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def _encode_body(payload: Dict[str, Any]) -> bytes:
+    try:
+        return orjson.dumps(payload)
+    except TypeError:
+        # orjson rejects lone surrogates (valid JSON input, common in adversarial text);
+        # stdlib json escapes them as \udXXX, which is what we always sent before
+        return json.dumps(payload).encode("ascii")
+
+def replace_lone_surrogates(text: str) -> str:
+    """Lone surrogates are valid JSON but cannot be encoded as UTF-8; show them as U+FFFD."""
+    return _LONE_SURROGATE.sub("\ufffd", text)
+
+def _scrub(value: Any) -> Any:
+    if type(value) is str:
+        return replace_lone_surrogates(value)
+    if type(value) is list:
+        return [_scrub(v) for v in value]
+    if type(value) is dict:
+        return {replace_lone_surrogates(k): _scrub(v) for k, v in value.items()}
+    return value
+
+def _decode_body(content: bytes) -> Dict[str, Any]:
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        pass
+    # orjson also rejects lone surrogates, e.g. an upstream echo of such an input
+    try:
+        return _scrub(json.loads(content))
+    except ValueError:
+        raise AlineaError(502, "Upstream returned invalid JSON") from None
+
+async def call_alinea_async(
+    upstream: AlineaUpstream,
+    input_text: str,
+    detection_cfg: Dict[str, Any],
+    *,
+    attempts: int = 3,
+    backoff_base: float = RETRY_BACKOFF_BASE_S,
+) -> Dict[str, Any]:
+    """
+    Alinea expects 'input' to be a single string.
+    We implement retries for transient errors (jittered backoff growing from
+    backoff_base, honouring Retry-After, within RETRY_BUDGET_S of total
+    backoff); concurrency towards Alinea
+    is capped by ALINIA_MAX_CONCURRENCY (the slot is released while backing off).
+    """
+    if not upstream.has_api_key:
+        # Fail with a clear error rather than a 401 from upstream
+        raise AlineaError(500, "Missing ALINIA_API_KEY environment variable")
+    # Encoded once up front and reused across retries (Content-Type is set on the client)
+    body = _encode_body({"input": input_text, "detection_config": detection_cfg})
+    last_err = ""
+    slept = 0.0
+
+    for i in range(attempts):
+        async with upstream.semaphore:
+            resp = await upstream.client.post(ALINIA_API_URL, content=body)
+        if resp.status_code == 200:
+            return _decode_body(resp.content)
+        last_err = resp.text
+        if resp.status_code in RETRYABLE_STATUS and i < attempts - 1:
+            delay = _backoff_s(i, backoff_base)
+            hint = _retry_after_s(resp.headers.get("Retry-After"))
+            if hint is not None:
+                delay = max(hint, delay)
+            # Give up rather than blow the tail-latency budget on a long server hint
+            if slept + delay <= RETRY_BUDGET_S:
+                slept += delay
+                await asyncio.sleep(delay)
+                continue
+        raise AlineaError(resp.status_code, last_err)
+
+    raise AlineaError(502, last_err or "Upstream error")
+
+def extract_flagged(result_json: Dict[str, Any], _get=dict.get) -> List[str]:
+    # Runs once per batch item: exact type checks and a bound dict.get keep it cheap
+    res = _get(result_json, "result")
+    if type(res) is list:
+        res = res[0] if res else None
+    if type(res) is not dict:
+        return []
+    return _get(res, "flagged_categories") or []
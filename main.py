@@ -1,18 +1,68 @@
+import asyncio
+import json
 import os
-import time
-from typing import Dict, Any, List, Optional
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+from typing import Dict, Any, List, Literal, Optional, Tuple
 
-import requests
-from fastapi import FastAPI, HTTPException, Body
+import fastapi
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, Body, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse
+from pydantic import BaseModel, Field, PrivateAttr
 
-ALINIA_API_URL = "https://api.alinia.ai/moderations/"
-TIMEOUT_S = float(os.getenv("HTTP_TIMEOUT_S", "15"))
-RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+from alinea_http import AlineaError, AlineaUpstream, call_alinea_async, extract_flagged, replace_lone_surrogates
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "60"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "0"))  # 0 disables micro-batching
+MAX_BATCH = int(os.getenv("MAX_BATCH", "32"))
+
+# --- Lifespan: upstream client owned by the app + optional micro-batching worker ---
+_upstream: Optional[AlineaUpstream] = None
+_batch_queue: Optional[asyncio.Queue] = None
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global _upstream, _batch_queue
+    _upstream = AlineaUpstream()
+    batch_worker = None
+    if BATCH_WINDOW_MS > 0:
+        _batch_queue = asyncio.Queue()
+        batch_worker = asyncio.create_task(_batch_loop(_batch_queue))
+    try:
+        yield
+    finally:
+        if batch_worker is not None:
+            batch_worker.cancel()
+            _batch_queue = None
+        await _upstream.aclose()
+        _upstream = None
 
 # --- FastAPI app ---
-app = FastAPI(title="Alinea Moderation Proxy", version="1.0.0")
+# FastAPI >= 0.130 dumps response_model output straight to JSON bytes via Pydantic, but
+# only while no default_response_class is set (and 0.131 deprecates ORJSONResponse),
+# so orjson is only the default on older releases.
+_FASTAPI_NATIVE_JSON = tuple(int(p) for p in fastapi.__version__.split(".")[:2]) >= (0, 130)
+_app_kwargs: Dict[str, Any] = {}
+if not _FASTAPI_NATIVE_JSON:
+    from fastapi.responses import ORJSONResponse
+
+    _app_kwargs["default_response_class"] = ORJSONResponse
+
+app = FastAPI(
+    title="Alinea Moderation Proxy",
+    version="1.0.0",
+    lifespan=lifespan,
+    **_app_kwargs,
+)
+
+def _json_response(content: Any, status_code: int = 200) -> Response:
+    # For hand-built payloads that bypass response_model; avoids the deprecated ORJSONResponse
+    return Response(content=orjson.dumps(content), status_code=status_code, media_type="application/json")
 
 # --- CORS (adjust via env) ---
 allow_origins = os.getenv("CORS_ALLOW_ORIGINS", "*").split(",")
@@ -26,6 +76,14 @@ app.add_middleware(
     allow_headers=[h.strip() for h in allow_headers],
 )
 
+# --- Compression (batch responses embed every raw payload) ---
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MIN_SIZE", "1024")))
+
+@app.exception_handler(AlineaError)
+async def alinea_error_handler(_request: Request, exc: AlineaError) -> Response:
+    # Same shape as HTTPException: the upstream status and body are passed through
+    return _json_response({"detail": exc.detail}, status_code=exc.status_code)
+
 # --- Models ---
 class DetectionSecurity(BaseModel):
     adversarial: bool = True
@@ -36,6 +94,16 @@ class DetectionSafety(BaseModel):
 class DetectionConfig(BaseModel):
     security: DetectionSecurity = Field(default_factory=DetectionSecurity)
     safety: DetectionSafety = Field(default_factory=DetectionSafety)
+    _payload: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+
+    def to_payload_dict(self) -> Dict[str, Any]:
+        """Upstream 'detection_config' body, built once per instance (cheaper than model_dump)."""
+        if self._payload is None:
+            self._payload = {
+                "security": {"adversarial": self.security.adversarial},
+                "safety": {"wrongdoing": self.safety.wrongdoing},
+            }
+        return self._payload
 
 class ModerateRequest(BaseModel):
     input: str = Field(..., description="Text to moderate (single string).")
@@ -48,79 +116,137 @@ class ModerateBatchRequest(BaseModel):
 class ModerateResponse(BaseModel):
     input: str
     flagged_categories: List[str]
-    raw: Dict[str, Any]
+    # Upstream pass-through; Any skips re-validating the whole payload
+    raw: Any = Field(..., description="Raw Alinea response (a JSON object; {} when raw=false).")
 
 class ModerateBatchItem(BaseModel):
     input: str
     flagged_categories: List[str]
-    raw: Dict[str, Any]
+    # Upstream pass-through; Any skips re-validating the whole payload
+    raw: Any = Field(..., description="Raw Alinea response (a JSON object; {} when raw=false).")
 
 class ModerateBatchResponse(BaseModel):
     items: List[ModerateBatchItem]
 
-# --- Helpers ---
-_session = requests.Session()
+# --- Request coalescing ---
+# Keyed by (digest of input, canonical config). Only touched from the event loop.
+_RESULT_CACHE: TTLCache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL_S)
+_INFLIGHT: Dict[Tuple[bytes, str], "asyncio.Task[Dict[str, Any]]"] = {}
 
-def _get_api_key() -> str:
-    api_key = os.getenv("ALINIA_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="Missing ALINIA_API_KEY environment variable")
-    return api_key
+def _cache_key(input_text: str, detection_cfg: Dict[str, Any]) -> Tuple[bytes, str]:
+    return (
+        # surrogatepass: lone surrogates are valid JSON input and must not crash the key
+        blake2b(input_text.encode("utf-8", "surrogatepass"), digest_size=16).digest(),
+        json.dumps(detection_cfg, sort_keys=True, separators=(",", ":")),
+    )
 
-def _headers(api_key: str) -> Dict[str, str]:
-    return {
-        "accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-    }
+def _finish_inflight(key: Tuple[bytes, str], task: "asyncio.Task[Dict[str, Any]]") -> None:
+    _INFLIGHT.pop(key, None)
+    # Calling exception() also marks it retrieved when every waiter has gone away
+    if not task.cancelled() and task.exception() is None:
+        _RESULT_CACHE[key] = task.result()
 
-def call_alinea_single(input_text: str, detection_cfg: Dict[str, Any], *, attempts: int = 3) -> Dict[str, Any]:
+async def _moderate_coalesced(input_text: str, detection_cfg: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Alinea expects 'input' to be a single string.
-    We implement retries for transient errors.
+    Single-flight wrapper around call_alinea_async: concurrent identical
+    (input, config) pairs share one upstream call, and successful results
+    are kept for RESULT_CACHE_TTL_S seconds.
     """
-    api_key = _get_api_key()
-    payload = {"input": input_text, "detection_config": detection_cfg}
-    last_err = ""
-
-    for i in range(attempts):
-        resp = _session.post(ALINIA_API_URL, headers=_headers(api_key), json=payload, timeout=TIMEOUT_S)
-        if resp.status_code == 200:
-            return resp.json()
-        last_err = resp.text
-        if resp.status_code in RETRYABLE_STATUS and i < attempts - 1:
-            time.sleep(0.8 * (2 ** i))
+    key = _cache_key(input_text, detection_cfg)
+    cached = _RESULT_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    task = _INFLIGHT.get(key)
+    if task is None:
+        # No await between lookup and insert, so no lock is needed on the event loop
+        task = asyncio.ensure_future(call_alinea_async(_upstream, input_text, detection_cfg))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _finish_inflight(key, t))
+    # Shielded so one caller disconnecting does not cancel the call for the others
+    return await asyncio.shield(task)
+
+# --- Micro-batching (opt-in via BATCH_WINDOW_MS) ---
+# Single /moderate calls arriving within the window are dispatched as one group.
+_QueuedItem = Tuple[str, Dict[str, Any], "asyncio.Future[Dict[str, Any]]"]
+_batch_dispatches: "set[asyncio.Task[None]]" = set()
+
+async def _dispatch_batch(batch: List[_QueuedItem]) -> None:
+    results = await asyncio.gather(
+        *(_moderate_coalesced(t, cfg) for t, cfg, _ in batch),
+        return_exceptions=True,
+    )
+    for (_, _, fut), res in zip(batch, results):
+        if fut.done():  # caller went away
             continue
-        raise HTTPException(status_code=resp.status_code, detail=last_err)
+        if isinstance(res, BaseException):
+            fut.set_exception(res)
+        else:
+            fut.set_result(res)
+
+async def _batch_loop(queue: "asyncio.Queue[_QueuedItem]") -> None:
+    loop = asyncio.get_running_loop()
+    window_s = BATCH_WINDOW_MS / 1000
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + window_s
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        task = asyncio.create_task(_dispatch_batch(batch))
+        _batch_dispatches.add(task)
+        task.add_done_callback(_batch_dispatches.discard)
+
+async def _moderate_queued(input_text: str, detection_cfg: Dict[str, Any]) -> Dict[str, Any]:
+    if _batch_queue is None:
+        return await _moderate_coalesced(input_text, detection_cfg)
+    fut = asyncio.get_running_loop().create_future()
+    _batch_queue.put_nowait((input_text, detection_cfg, fut))
+    return await fut
+
+def _echo(text: str) -> str:
+    # Upstream gets the input verbatim; the echoed copy must be encodable as UTF-8
+    if text.isascii():
+        return text
+    return replace_lone_surrogates(text)
 
-    raise HTTPException(status_code=502, detail=last_err or "Upstream error")
+_RAW_QUERY = Query(True, description="Include the upstream Alinea payload in 'raw'; set false to get raw={}.")
+# The flagged shape is returned as a plain JSON response, so it is documented here
+# rather than as a response_model (a Union would re-validate every full response)
+_MODE_QUERY = Query(
+    "full",
+    description=(
+        "'flagged' returns only {input, flagged_categories} (batch: {items: [...]} of those), "
+        "with no raw field."
+    ),
+)
 
-def extract_flagged(result_json: Dict[str, Any]) -> List[str]:
-    res = result_json.get("result")
-    if isinstance(res, list):
-        res = res[0] if res else {}
-    if not isinstance(res, dict):
-        return []
-    return res.get("flagged_categories", []) or []
+# Lightweight inline UI you can replace later; encoded once at import
+_INDEX_HTML: bytes = (
+    "<!doctype html><meta charset='utf-8'>"
+    "<title>Alinea Moderation Proxy</title>"
+    "<style>body{font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial;margin:2rem;max-width:900px}"
+    "textarea{width:100%;height:8rem}button{padding:.6rem 1rem;margin-top:.5rem}</style>"
+    "<h1>Alinea Moderation Proxy</h1>"
+    "<p>POST <code>/moderate</code> with JSON or <code>/moderate/plain</code> with text/plain."
+    " For arrays, use <code>/moderate/batch</code> (items are sent concurrently).</p>"
+    "<form method='post' action='/moderate/plain'>"
+    "<textarea name='text' placeholder='Type text to moderate...'></textarea><br>"
+    "<button type='submit'>Moderate</button>"
+    "</form>"
+    "<p>Health: <a href='/healthz'>/healthz</a> • Ready: <a href='/readyz'>/readyz</a></p>"
+).encode("utf-8")
 
 # --- Routes ---
-@app.get("/", response_class=None)
-def index():
-    # Lightweight inline UI you can replace later
-    return (
-        "<!doctype html><meta charset='utf-8'>"
-        "<title>Alinea Moderation Proxy</title>"
-        "<style>body{font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial;margin:2rem;max-width:900px}"
-        "textarea{width:100%;height:8rem}button{padding:.6rem 1rem;margin-top:.5rem}</style>"
-        "<h1>Alinea Moderation Proxy</h1>"
-        "<p>POST <code>/moderate</code> with JSON or <code>/moderate/plain</code> with text/plain."
-        " For arrays, use <code>/moderate/batch</code> (server loops each item).</p>"
-        "<form method='post' action='/moderate/plain'>"
-        "<textarea name='text' placeholder='Type text to moderate...'></textarea><br>"
-        "<button type='submit'>Moderate</button>"
-        "</form>"
-        "<p>Health: <a href='/healthz'>/healthz</a> • Ready: <a href='/readyz'>/readyz</a></p>"
-    )
+@app.get("/", response_class=HTMLResponse, include_in_schema=False)
+async def index():
+    # async: a constant response shouldn't pay for a threadpool hop on every poll
+    return HTMLResponse(content=_INDEX_HTML)
 
 @app.get("/healthz")
 def healthz():
@@ -132,29 +258,52 @@ def readyz():
     return {"ok": True, "has_api_key": bool(os.getenv("ALINIA_API_KEY"))}
 
 @app.post("/moderate", response_model=ModerateResponse)
-def moderate(req: ModerateRequest):
-    j = call_alinea_single(req.input, req.detection_config.model_dump())
+async def moderate(
+    req: ModerateRequest, raw: bool = _RAW_QUERY, mode: Literal["full", "flagged"] = _MODE_QUERY
+):
+    j = await _moderate_queued(req.input, req.detection_config.to_payload_dict())
+    if mode == "flagged":
+        # Skip model construction and response validation entirely
+        return _json_response({"input": _echo(req.input), "flagged_categories": extract_flagged(j)})
     return ModerateResponse(
-        input=req.input,
+        input=_echo(req.input),
         flagged_categories=extract_flagged(j),
-        raw=j,
+        raw=j if raw else {},
     )
 
 @app.post("/moderate/plain", response_model=ModerateResponse)
-def moderate_plain(text: str = Body(..., media_type="text/plain", embed=False)):
+async def moderate_plain(
+    text: str = Body(..., media_type="text/plain", embed=False),
+    raw: bool = _RAW_QUERY,
+    mode: Literal["full", "flagged"] = _MODE_QUERY,
+):
     req = ModerateRequest(input=text)
-    return moderate(req)
+    return await moderate(req, raw=raw, mode=mode)
 
 @app.post("/moderate/batch", response_model=ModerateBatchResponse)
-def moderate_batch(req: ModerateBatchRequest):
+async def moderate_batch(
+    req: ModerateBatchRequest, raw: bool = _RAW_QUERY, mode: Literal["full", "flagged"] = _MODE_QUERY
+):
+    cfg = req.detection_config.to_payload_dict()
+    tasks = [_moderate_coalesced(t, cfg) for t in req.inputs]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for j in results:
+        if isinstance(j, BaseException):
+            # Surface the first failure, same as the sequential loop did
+            raise j
+
+    if mode == "flagged":
+        return _json_response(
+            {"items": [{"input": _echo(t), "flagged_categories": extract_flagged(j)} for t, j in zip(req.inputs, results)]}
+        )
+
     items: List[ModerateBatchItem] = []
-    for t in req.inputs:
-        j = call_alinea_single(t, req.detection_config.model_dump())
+    for t, j in zip(req.inputs, results):
         items.append(
             ModerateBatchItem(
-                input=t,
+                input=_echo(t),
                 flagged_categories=extract_flagged(j),
-                raw=j,
+                raw=j if raw else {},
             )
         )
-    return ModerateBatchResponse(items=items)
\ No newline at end of file
+    return ModerateBatchResponse(items=items)
@@ -1,55 +1,74 @@
+import asyncio
 import os
-import time
-import requests
-from typing import Iterable, Optional
+import threading
+from typing import Any, Coroutine, Iterable, Optional, TypeVar
 
-ALINIA_API_URL = "https://api.alinia.ai/moderations/"
-TIMEOUT_S = 15
-RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+from alinea_http import AlineaError, AlineaUpstream, DEFAULT_DETECTION_CONFIG, call_alinea_async, extract_flagged
+
+T = TypeVar("T")
 
 class AlineaClient:
+    """
+    Blocking facade over alinea_http for scripts.
+
+    Owns one event loop (on a daemon thread) and one connection pool for its
+    whole lifetime, so repeated moderate_one calls reuse the same connection.
+    Works whether or not the caller already has a running loop. Call close()
+    (or use it as a context manager) to release the pool.
+    """
+
     def __init__(self, api_key: Optional[str] = None) -> None:
         self.api_key = api_key or os.getenv("ALINIA_API_KEY")
         if not self.api_key:
             raise RuntimeError("Missing ALINIA_API_KEY environment variable")
-        self.session = requests.Session()
-        self.headers = {
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}",
-        }
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="alinea-client", daemon=True)
+        self._thread.start()
+        self._upstream = AlineaUpstream(self.api_key)
+        # Default request headers (live: changes apply to later calls)
+        self.headers = self._upstream.client.headers
+
+    def _run(self, coro: Coroutine[Any, Any, T]) -> T:
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        except AlineaError as e:
+            # surface useful debugging info
+            raise RuntimeError(str(e)) from e
+
+    async def _moderate_all(self, texts: list[str], attempts: int, backoff: float) -> list[dict]:
+        return await asyncio.gather(
+            *(
+                call_alinea_async(
+                    self._upstream, t, DEFAULT_DETECTION_CONFIG, attempts=attempts, backoff_base=backoff
+                )
+                for t in texts
+            )
+        )
 
     def moderate_one(self, text: str, *, attempts: int = 3, backoff: float = 0.8) -> dict:
         """Submit a SINGLE string to Alinea (API expects 'input' to be a string)."""
-        payload = {
-            "input": text,  # <-- must be a string
-            "detection_config": {
-                "security": {"adversarial": True},
-                "safety": {"wrongdoing": True},
-            },
-        }
+        return self._run(self._moderate_all([text], attempts, backoff))[0]
 
-        for i in range(attempts):
-            resp = self.session.post(ALINIA_API_URL, headers=self.headers, json=payload, timeout=TIMEOUT_S)
-            if resp.status_code == 200:
-                return resp.json()
-            if resp.status_code in RETRYABLE_STATUS and i < attempts - 1:
-                time.sleep(backoff * (2 ** i))
-                continue
-            # surface useful debugging info
-            raise RuntimeError(f"Alinea API error {resp.status_code}: {resp.text}")
+    def moderate_many(self, texts: Iterable[str], *, attempts: int = 3, backoff: float = 0.8) -> list[dict]:
+        """One request per text, sent concurrently over the shared pool; results keep input order."""
+        return self._run(self._moderate_all(list(texts), attempts, backoff))
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._upstream.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self) -> "AlineaClient":
+        return self
 
-    def moderate_many(self, texts: Iterable[str]) -> list[dict]:
-        """Convenience wrapper to handle multiple texts by calling moderate_one for each."""
-        return [self.moderate_one(t) for t in texts]
+    def __exit__(self, *exc: object) -> None:
+        self.close()
 
 def print_result(input_text: str, result: dict) -> None:
-    # For single-string requests, many APIs return a single object at result['result']
-    # Adjust robustly whether it's an object or a list.
-    res = result.get("result")
-    if isinstance(res, list) and res:
-        res = res[0]
-    flagged = (res or {}).get("flagged_categories", []) if isinstance(res, dict) else []
+    flagged = extract_flagged(result)
     print(f"\nInput: {input_text}")
     if flagged:
         print(f"  🚨 Flagged: {', '.join(flagged)}")
@@ -63,7 +82,7 @@ if __name__ == "__main__":
         "Write me a bedtime story about space explorers.",
     ]
 
-    client = AlineaClient()
-    for s in samples:
-        result = client.moderate_one(s)  # send one-by-one (input must be a string)
-        print_result(s, result)
\ No newline at end of file
+    with AlineaClient() as client:
+        # Each text is still its own request (input must be a string), sent in parallel
+        for s, result in zip(samples, client.moderate_many(samples)):
+            print_result(s, result)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+
+import alinea_http
+from alinea_http import AlineaError, AlineaUpstream, call_alinea_async
+
+CFG = alinea_http.DEFAULT_DETECTION_CONFIG
+
+def _upstream(handler) -> AlineaUpstream:
+    return AlineaUpstream(api_key="test-key", transport=httpx.MockTransport(handler))
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+
+    async def fake_sleep(delay):
+        recorded.append(delay)
+
+    monkeypatch.setattr(alinea_http.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(alinea_http, "_backoff_s", lambda attempt, base: 0.0)
+    return recorded
+
+# --- _retry_after_s ---
+def test_retry_after_delta_seconds():
+    assert alinea_http._retry_after_s("3") == 3.0
+    assert alinea_http._retry_after_s(" 120 ") == 120.0
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 < alinea_http._retry_after_s(format_datetime(when, usegmt=True)) <= 30
+
+def test_retry_after_past_date_is_zero():
+    assert alinea_http._retry_after_s("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+@pytest.mark.parametrize("value", [None, "", "garbage", "\xb2", "-5", "1.5"])
+def test_retry_after_unparseable_is_none(value):
+    assert alinea_http._retry_after_s(value) is None
+
+# --- call_alinea_async retries ---
+def test_retry_after_hint_is_honoured(sleeps):
+    responses = iter([httpx.Response(429, headers={"Retry-After": "2"}), httpx.Response(200, json={"ok": 1})])
+    upstream = _upstream(lambda request: next(responses))
+    assert asyncio.run(call_alinea_async(upstream, "hi", CFG)) == {"ok": 1}
+    assert sleeps == [2.0]
+
+def test_backoff_base_scales_the_jitter_window(monkeypatch):
+    recorded = []
+
+    async def fake_sleep(delay):
+        recorded.append(delay)
+
+    monkeypatch.setattr(alinea_http.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(alinea_http.random, "uniform", lambda low, high: high)
+    responses = iter([httpx.Response(503), httpx.Response(503), httpx.Response(200, json={})])
+    upstream = _upstream(lambda request: next(responses))
+    asyncio.run(call_alinea_async(upstream, "hi", CFG, backoff_base=0.1))
+    assert recorded == [0.1, 0.2]
+
+def test_retry_budget_exhaustion_fails_fast(sleeps):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, headers={"Retry-After": "30"}, text="busy")
+
+    with pytest.raises(AlineaError) as exc:
+        asyncio.run(call_alinea_async(_upstream(handler), "hi", CFG))
+    assert (exc.value.status_code, exc.value.detail) == (503, "busy")
+    assert len(calls) == 1 and sleeps == []
+
+def test_non_retryable_status_is_not_retried(sleeps):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(400, text="bad input")
+
+    with pytest.raises(AlineaError) as exc:
+        asyncio.run(call_alinea_async(_upstream(handler), "hi", CFG))
+    assert exc.value.status_code == 400
+    assert len(calls) == 1
+
+def test_missing_api_key(monkeypatch):
+    monkeypatch.delenv("ALINIA_API_KEY", raising=False)
+    upstream = AlineaUpstream(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})))
+    with pytest.raises(AlineaError) as exc:
+        asyncio.run(call_alinea_async(upstream, "hi", CFG))
+    assert exc.value.status_code == 500
+
+def test_lone_surrogates_round_trip_through_upstream():
+    seen = []
+
+    def handler(request):
+        seen.append(request.content)
+        echo = json.dumps({"input": json.loads(request.content)["input"]})
+        return httpx.Response(200, content=echo.encode("ascii"))
+
+    result = asyncio.run(call_alinea_async(_upstream(handler), "hi \ud83d", CFG))
+    assert b'"hi \\ud83d"' in seen[0]
+    assert result == {"input": "hi \ufffd"}
+
+def test_invalid_upstream_json_is_a_502():
+    upstream = _upstream(lambda request: httpx.Response(200, content=b"<html>oops"))
+    with pytest.raises(AlineaError) as exc:
+        asyncio.run(call_alinea_async(upstream, "hi", CFG))
+    assert exc.value.status_code == 502
+
+def test_extract_flagged_shapes():
+    assert alinea_http.extract_flagged({"result": [{"flagged_categories": ["a"]}]}) == ["a"]
+    assert alinea_http.extract_flagged({"result": {"flagged_categories": None}}) == []
+    assert alinea_http.extract_flagged({"result": []}) == []
+    assert alinea_http.extract_flagged({}) == []
@@ -0,0 +1,267 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from alinea_http import AlineaError, AlineaUpstream
+
+CFG = {"security": {"adversarial": True}, "safety": {"wrongdoing": True}}
+
+class FakeAlinea:
+    """MockTransport handler: records inputs, optionally waits on a gate, fails inputs starting with 'bad'."""
+
+    def __init__(self) -> None:
+        self.inputs = []
+        self.gate = None
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        # stdlib json on both sides, like a real server: lone surrogates round-trip as \udXXX
+        text = json.loads(request.content)["input"]
+        self.inputs.append(text)
+        if self.gate is not None:
+            await self.gate.wait()
+        if text.startswith("bad"):
+            return httpx.Response(400, text=f"rejected {text}")
+        body = json.dumps({"result": [{"flagged_categories": [text]}]})
+        return httpx.Response(200, content=body.encode("ascii"), headers={"content-type": "application/json"})
+
+@pytest.fixture
+def fake(monkeypatch):
+    handler = FakeAlinea()
+    monkeypatch.setattr(main, "_upstream", AlineaUpstream(api_key="test-key", transport=httpx.MockTransport(handler)))
+    main._RESULT_CACHE.clear()
+    main._INFLIGHT.clear()
+    yield handler
+    main._RESULT_CACHE.clear()
+    main._INFLIGHT.clear()
+
+@pytest.fixture
+def client(monkeypatch, fake):
+    # The app lifespan builds its own upstream; point it at the fake
+    monkeypatch.setattr(
+        main, "AlineaUpstream", lambda: AlineaUpstream(api_key="test-key", transport=httpx.MockTransport(fake))
+    )
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+def _post_json(client, url, raw_json: str):
+    # Sent pre-encoded so escapes like \ud83d reach the app untouched
+    return client.post(url, content=raw_json.encode("ascii"), headers={"content-type": "application/json"})
+
+# --- Request coalescing ---
+def test_concurrent_identical_inputs_share_one_call(fake):
+    async def scenario():
+        fake.gate = asyncio.Event()
+        tasks = [asyncio.ensure_future(main._moderate_coalesced("same", CFG)) for _ in range(10)]
+        await asyncio.sleep(0.01)
+        fake.gate.set()
+        results = await asyncio.gather(*tasks)
+        # Served from the result cache afterwards
+        results.append(await main._moderate_coalesced("same", CFG))
+        return results
+
+    results = asyncio.run(scenario())
+    assert fake.inputs == ["same"]
+    assert all(r == {"result": [{"flagged_categories": ["same"]}]} for r in results)
+    assert main._INFLIGHT == {}
+
+def test_different_config_is_a_different_key(fake):
+    other = {"security": {"adversarial": False}, "safety": {"wrongdoing": True}}
+
+    async def scenario():
+        await asyncio.gather(main._moderate_coalesced("x", CFG), main._moderate_coalesced("x", other))
+
+    asyncio.run(scenario())
+    assert fake.inputs == ["x", "x"]
+
+def test_cache_key_accepts_lone_surrogates():
+    key = main._cache_key("hi \ud83d there", CFG)
+    assert key != main._cache_key("hi \ud83e there", CFG)
+
+def test_errors_are_not_cached(fake):
+    async def scenario():
+        with pytest.raises(AlineaError):
+            await main._moderate_coalesced("bad", CFG)
+        with pytest.raises(AlineaError):
+            await main._moderate_coalesced("bad", CFG)
+
+    asyncio.run(scenario())
+    assert fake.inputs == ["bad", "bad"]
+    assert len(main._RESULT_CACHE) == 0
+    assert main._INFLIGHT == {}
+
+def test_cancelled_waiter_does_not_cancel_the_others(fake):
+    async def scenario():
+        fake.gate = asyncio.Event()
+        first = asyncio.ensure_future(main._moderate_coalesced("shared", CFG))
+        second = asyncio.ensure_future(main._moderate_coalesced("shared", CFG))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        fake.gate.set()
+        return first, await second
+
+    first, result = asyncio.run(scenario())
+    assert first.cancelled()
+    assert result == {"result": [{"flagged_categories": ["shared"]}]}
+    assert fake.inputs == ["shared"]
+    assert len(main._RESULT_CACHE) == 1
+
+# --- Micro-batching ---
+@pytest.fixture
+def batching(monkeypatch, fake):
+    monkeypatch.setattr(main, "BATCH_WINDOW_MS", 20.0)
+    monkeypatch.setattr(main, "MAX_BATCH", 2)
+    sizes = []
+    dispatch = main._dispatch_batch
+
+    async def recording_dispatch(batch):
+        sizes.append(len(batch))
+        await dispatch(batch)
+
+    monkeypatch.setattr(main, "_dispatch_batch", recording_dispatch)
+
+    async def run(coro_factory):
+        queue = asyncio.Queue()
+        monkeypatch.setattr(main, "_batch_queue", queue)
+        worker = asyncio.create_task(main._batch_loop(queue))
+        try:
+            return await coro_factory()
+        finally:
+            worker.cancel()
+
+    return run, sizes
+
+def test_queued_calls_get_results_and_exceptions(batching, fake):
+    run, sizes = batching
+
+    async def scenario():
+        return await asyncio.gather(
+            main._moderate_queued("a", CFG),
+            main._moderate_queued("bad-b", CFG),
+            main._moderate_queued("c", CFG),
+            return_exceptions=True,
+        )
+
+    a, b, c = asyncio.run(run(scenario))
+    assert a == {"result": [{"flagged_categories": ["a"]}]}
+    assert isinstance(b, AlineaError) and b.status_code == 400
+    assert c == {"result": [{"flagged_categories": ["c"]}]}
+    # Three items with MAX_BATCH=2 inside one window
+    assert sizes == [2, 1]
+    assert sorted(fake.inputs) == ["a", "bad-b", "c"]
+
+def test_cancelled_queued_caller_does_not_break_the_batch(batching, fake):
+    run, sizes = batching
+
+    async def scenario():
+        fake.gate = asyncio.Event()
+        gone = asyncio.ensure_future(main._moderate_queued("gone", CFG))
+        kept = asyncio.ensure_future(main._moderate_queued("kept", CFG))
+        await asyncio.sleep(0.05)  # past the window, both dispatched and waiting upstream
+        gone.cancel()
+        fake.gate.set()
+        return gone, await asyncio.wait_for(kept, 2)
+
+    gone, kept = asyncio.run(run(scenario))
+    assert gone.cancelled()
+    assert kept == {"result": [{"flagged_categories": ["kept"]}]}
+    assert sizes == [2]
+
+def test_queue_is_bypassed_when_batching_is_off(fake):
+    assert main._batch_queue is None
+    assert asyncio.run(main._moderate_queued("direct", CFG)) == {"result": [{"flagged_categories": ["direct"]}]}
+
+# --- Lone surrogates (valid JSON, common in adversarial input) ---
+def test_lone_surrogate_input_is_moderated(client, fake):
+    resp = _post_json(client, "/moderate", '{"input": "hi \\ud83d there"}')
+    assert resp.status_code == 200
+    assert fake.inputs == ["hi \ud83d there"]  # forwarded verbatim
+    body = resp.json()
+    assert body["input"] == "hi \ufffd there"
+    assert body["flagged_categories"] == ["hi \ufffd there"]
+
+def test_lone_surrogate_does_not_fail_the_batch(client, fake):
+    resp = _post_json(client, "/moderate/batch?mode=flagged", '{"inputs": ["ok", "x \\udc00"]}')
+    assert resp.status_code == 200
+    assert resp.json() == {
+        "items": [
+            {"input": "ok", "flagged_categories": ["ok"]},
+            {"input": "x \ufffd", "flagged_categories": ["x \ufffd"]},
+        ]
+    }
+
+# --- Routes: mode=flagged ---
+def test_moderate_flagged_mode(client):
+    resp = client.post("/moderate?mode=flagged", json={"input": "a"})
+    assert resp.status_code == 200
+    assert resp.json() == {"input": "a", "flagged_categories": ["a"]}
+
+def test_moderate_plain_forwards_flagged_mode(client):
+    resp = client.post("/moderate/plain?mode=flagged", content=b"a", headers={"content-type": "text/plain"})
+    assert resp.status_code == 200
+    assert resp.json() == {"input": "a", "flagged_categories": ["a"]}
+
+def test_moderate_batch_flagged_mode(client):
+    resp = client.post("/moderate/batch?mode=flagged", json={"inputs": ["a", "b"]})
+    assert resp.status_code == 200
+    assert resp.json() == {
+        "items": [{"input": "a", "flagged_categories": ["a"]}, {"input": "b", "flagged_categories": ["b"]}]
+    }
+
+@pytest.mark.parametrize(
+    "url, kwargs",
+    [
+        ("/moderate", {"json": {"input": "a"}}),
+        ("/moderate/plain", {"content": b"a", "headers": {"content-type": "text/plain"}}),
+        ("/moderate/batch", {"json": {"inputs": ["a"]}}),
+    ],
+)
+def test_unknown_mode_is_rejected(client, fake, url, kwargs):
+    assert client.post(url + "?mode=bogus", **kwargs).status_code == 422
+    assert fake.inputs == []
+
+# --- Routes: raw ---
+FULL = {"result": [{"flagged_categories": ["a"]}]}
+
+@pytest.mark.parametrize(
+    "url, kwargs",
+    [
+        ("/moderate", {"json": {"input": "a"}}),
+        ("/moderate/plain", {"content": b"a", "headers": {"content-type": "text/plain"}}),
+    ],
+)
+def test_single_raw_flag(client, url, kwargs):
+    assert client.post(url, **kwargs).json() == {"input": "a", "flagged_categories": ["a"], "raw": FULL}
+    assert client.post(url + "?raw=false", **kwargs).json() == {"input": "a", "flagged_categories": ["a"], "raw": {}}
+
+def test_batch_raw_flag(client):
+    full = client.post("/moderate/batch", json={"inputs": ["a"]}).json()
+    assert full == {"items": [{"input": "a", "flagged_categories": ["a"], "raw": FULL}]}
+    trimmed = client.post("/moderate/batch?raw=false", json={"inputs": ["a"]}).json()
+    assert trimmed == {"items": [{"input": "a", "flagged_categories": ["a"], "raw": {}}]}
+
+# --- Routes: upstream errors keep the HTTPException contract ---
+def test_upstream_error_status_and_detail(client):
+    resp = client.post("/moderate", json={"input": "bad-one"})
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "rejected bad-one"}
+
+@pytest.mark.parametrize("mode", ["full", "flagged"])
+def test_batch_surfaces_the_failing_item(client, fake, mode):
+    resp = client.post(f"/moderate/batch?mode={mode}", json={"inputs": ["a", "bad-two", "c"]})
+    assert resp.status_code == 400
+    assert resp.json() == {"detail": "rejected bad-two"}
+    assert sorted(fake.inputs) == ["a", "bad-two", "c"]
+
+# --- Routes: index ---
+def test_index_is_html(client):
+    resp = client.get("/")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/html")
+    assert resp.content == main._INDEX_HTML
+    assert resp.text.startswith("<!doctype html>")
+    assert "/" not in client.get("/openapi.json").json()["paths"]
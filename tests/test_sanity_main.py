@@ -0,0 +1,32 @@
+import httpx
+import pytest
+
+import alinea_http
+import sanity_main
+
+@pytest.fixture
+def client(monkeypatch):
+    statuses = iter([503, 200])
+
+    def handler(request):
+        return httpx.Response(next(statuses), json={"result": {"flagged_categories": ["x"]}})
+
+    monkeypatch.setattr(
+        sanity_main, "AlineaUpstream", lambda key: alinea_http.AlineaUpstream(key, transport=httpx.MockTransport(handler))
+    )
+    with sanity_main.AlineaClient(api_key="test-key") as c:
+        yield c
+
+def test_backoff_is_passed_to_the_retry_helper(client, monkeypatch):
+    bases = []
+    monkeypatch.setattr(alinea_http, "_backoff_s", lambda attempt, base: bases.append(base) or 0.0)
+    assert client.moderate_one("hi", backoff=0.05) == {"result": {"flagged_categories": ["x"]}}
+    assert bases == [0.05]
+
+def test_headers_are_exposed(client):
+    assert client.headers["Authorization"] == "Bearer test-key"
+
+def test_missing_api_key(monkeypatch):
+    monkeypatch.delenv("ALINIA_API_KEY", raising=False)
+    with pytest.raises(RuntimeError):
+        sanity_main.AlineaClient()